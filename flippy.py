@@ -6,20 +6,30 @@
 # Copyright © 2016-2020 Oliver Lau <ola@ct.de>, Heise Medien GmbH & Co. KG
 # All rights reserved.
 
+import io
 import os
 import sys
 import argparse
-from PIL import Image, GifImagePlugin
+from dataclasses import dataclass
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import av
+import numpy as np
+from PIL import Image
 from fpdf import FPDF
-from moviepy.editor import *
+from tqdm import tqdm
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
+@dataclass(slots=True, frozen=True)
 class Size:
     """ Class to store the size of a rectangle."""
-
-    def __init__(self, width=0, height=0):
-        self.width = width
-        self.height = height
+    width: float = 0
+    height: float = 0
 
     def to_tuple(self):
         return self.width, self.height
@@ -32,25 +42,23 @@ class Size:
         return Size(sz[0], sz[1])
 
 
+@dataclass(slots=True, frozen=True)
 class Point:
     """ Class to store a point on a 2D plane."""
-
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+    x: float
+    y: float
 
     def __str__(self):
         return f'Point({self.x}, {self.y})'
 
 
+@dataclass(slots=True, frozen=True)
 class Margin:
     """ Class to store the margins of a rectangular boundary."""
-
-    def __init__(self, top, right, bottom, left):
-        self.top = top
-        self.right = right
-        self.bottom = bottom
-        self.left = left
+    top: float
+    right: float
+    bottom: float
+    left: float
 
     def __str__(self):
         return f'Margin({self.top}, {self.right}, {self.bottom}, {self.left})'
@@ -62,18 +70,195 @@ class AnimatedGif:
     def __init__(self, im):
         self.im = im
 
-    def __getitem__(self, ix):
-        try:
-            if ix:
-                self.im.seek(ix)
-            return self.im
-        except EOFError:
-            raise IndexError
+    def __iter__(self):
+        # Frames are decoded in order exactly once. The same Image object
+        # is yielded every time, so a frame is only valid until the next one.
+        self.im.seek(0)
+        yield self.im
+        while True:
+            try:
+                self.im.seek(self.im.tell() + 1)
+            except EOFError:
+                return
+            yield self.im
 
     def open(self, file_name):
         self.im = Image.open(file_name)
 
 
+def stream_start(stream):
+    """ Presentation time of the first frame of a stream in seconds """
+    if stream.start_time is None:
+        return 0.0
+    return float(stream.start_time * stream.time_base)
+
+
+def decode_from(file_name, seek, times, size=(None, None),
+                interpolation='BILINEAR', keyframes_only=False):
+    """ Decode the frames on screen at the given times (in seconds from the
+    start of the stream), starting at the keyframe at or before seek.
+    Returns None if the container seeked past the first of the times."""
+    width, height = size
+    frames = []
+    with av.open(file_name) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = 'AUTO'
+        if keyframes_only:
+            stream.codec_context.skip_frame = 'NONKEY'
+        # compare in stream ticks, where frame timestamps are exact
+        start_pts = stream.start_time or 0
+        targets = iter([start_pts + round(t / stream.time_base) for t in times])
+        target = next(targets, None)
+        if seek > 0:
+            container.seek(start_pts + round(seek / stream.time_base),
+                           any_frame=False, backward=True, stream=stream)
+        last = None
+        for frame in container.decode(stream):
+            if target is None:
+                break
+            if frame.pts is None:
+                continue
+            if frame.pts > target:
+                if last is None:
+                    if seek > 0:
+                        return None
+                    # nothing precedes the first frame of the stream
+                    last = frame
+                # emit the frame that is on screen at the target time; a
+                # frame shown more than once is converted (and pickled) once
+                pixels = last.to_ndarray(
+                    width=width, height=height, format='rgba', interpolation=interpolation)
+                while target is not None and frame.pts > target:
+                    frames.append(pixels)
+                    target = next(targets, None)
+            last = frame
+        if target is not None and last is not None:
+            pixels = last.to_ndarray(
+                width=width, height=height, format='rgba', interpolation=interpolation)
+            while target is not None:
+                frames.append(pixels)
+                target = next(targets, None)
+    return frames
+
+
+def decode_segment(file_name, seek_points, times, size=(None, None),
+                   interpolation='BILINEAR', keyframes_only=False):
+    """ Decode the frames on screen at the given times (in seconds from the
+    start of the stream), scaled to size by ffmpeg's swscale.
+    Some containers (MPEG-TS, for one) seek past the requested keyframe,
+    so decoding is retried from the next of seek_points, latest first,
+    until it starts early enough. Meant to run in a worker process."""
+    for seek in seek_points:
+        frames = decode_from(file_name, seek, times, size, interpolation, keyframes_only)
+        if frames is not None:
+            return frames
+    return decode_from(file_name, 0, times, size, interpolation, keyframes_only)
+
+
+DCT_MATRIX = np.cos(np.pi / 32 * np.outer(np.arange(32), np.arange(32) + 0.5))
+
+
+def phash(im):
+    """ 64-bit perceptual hash of an image, taken from the signs of the
+    lowest 8x8 DCT coefficients of a 32x32 grayscale thumbnail """
+    pixels = np.asarray(im.resize((32, 32), Image.Resampling.BILINEAR).convert('L'),
+                        dtype=np.float32)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:8, :8]
+    bits = np.packbits(low > np.median(low))
+    return int.from_bytes(bits.tobytes(), 'big')
+
+
+def encode(im, fingerprint=False):
+    """ Encode an image as JPEG; returns its perceptual hash (if a
+    fingerprint is requested, else None) and the JPEG data """
+    buf = io.BytesIO()
+    im.save(buf, format='JPEG', quality=85, subsampling='4:2:0', optimize=False)
+    buf.seek(0)
+    return phash(im) if fingerprint else None, buf
+
+
+def encode_pixels(f, fingerprint=False):
+    """ Like encode(), but for an array of RGBX pixels """
+    if not f.flags['C_CONTIGUOUS']:
+        f = np.ascontiguousarray(f)
+    # 4 bytes per pixel match Pillow's own layout, so the image maps the
+    # array's memory instead of copying it
+    return encode(Image.frombuffer('RGBX', (f.shape[1], f.shape[0]), f, 'raw', 'RGBX', 0, 1),
+                  fingerprint)
+
+
+if numba:
+    @numba.njit(parallel=True, cache=True, fastmath=True)
+    def composite(canvas, layer):
+        """ Copy the opaque pixels of an RGBA layer onto an RGB canvas """
+        for y in numba.prange(layer.shape[0]):
+            for x in range(layer.shape[1]):
+                if layer[y, x, 3] != 0:
+                    canvas[y, x, 0] = layer[y, x, 0]
+                    canvas[y, x, 1] = layer[y, x, 1]
+                    canvas[y, x, 2] = layer[y, x, 2]
+else:
+    def composite(canvas, layer):
+        """ Copy the opaque pixels of an RGBA layer onto an RGB canvas """
+        np.copyto(canvas, layer[..., :3], where=layer[..., 3:] != 0)
+
+
+class VideoClip:
+    """ Generator for a sequence of RGBX pixel arrays from a video file,
+    decoded in parallel in runs of consecutive frames """
+
+    SEGMENT_FRAMES = 64
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with av.open(file_name) as container:
+            stream = container.streams.video[0]
+            self.fps = float(stream.average_rate or stream.guessed_rate)
+            self.size = stream.codec_context.width, stream.codec_context.height
+            if stream.duration is not None:
+                self.duration = float(stream.duration * stream.time_base)
+            elif container.duration is not None:
+                self.duration = container.duration / av.time_base
+            else:
+                raise ValueError(f'Cannot determine the duration of {file_name}')
+            # keyframe times relative to the start of the stream
+            start_time = stream_start(stream)
+            self.keyframes = [float(packet.pts * packet.time_base) - start_time
+                              for packet in container.demux(stream)
+                              if packet.is_keyframe and packet.pts is not None]
+
+    def frame_times(self, fps):
+        return [ix / fps for ix in range(int(self.duration * fps))]
+
+    def iter_frames(self, fps, size=(None, None), interpolation='BILINEAR'):
+        times = self.frame_times(fps)
+        workers = os.cpu_count() or 1
+        keyframes = self.keyframes or [0.0]
+        # Decoding keyframes only is good enough if a keyframe is never
+        # more than a quarter of an output frame away.
+        gaps = [b - a for a, b in zip(keyframes, keyframes[1:] + [self.duration])]
+        keyframes_only = max(gaps) <= 1 / (4 * fps)
+        # Cut the output times into runs of at most SEGMENT_FRAMES frames
+        # regardless of the keyframe spacing, so that the decoded frames
+        # kept in memory do not grow with the length of the video. A run
+        # starting inside a GOP is decoded from the keyframe before it.
+        length = max(1, min(self.SEGMENT_FRAMES, -(-len(times) // workers)))
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for ix in range(0, len(times), length):
+                segment_times = times[ix:ix + length]
+                # the keyframe at or before the run and the two before it
+                k = bisect_right(keyframes, segment_times[0])
+                seek_points = keyframes[max(0, k - 3):k][::-1]
+                pending.append(executor.submit(decode_segment, self.file_name,
+                                               seek_points, segment_times,
+                                               size, interpolation, keyframes_only))
+                if len(pending) > workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+
 class FlipbookCreator:
     PAPER_SIZES = {
         'a5': Size(210, 148),
@@ -83,6 +268,13 @@ class FlipbookCreator:
         'legal': Size(355.6, 215.9)
     }
     PAPER_CHOICES = PAPER_SIZES.keys()
+    RESAMPLE_FILTERS = {
+        'nearest': 'POINT',
+        'bilinear': 'BILINEAR',
+        'bicubic': 'BICUBIC',
+        'lanczos': 'LANCZOS'
+    }
+    RESAMPLE_CHOICES = RESAMPLE_FILTERS.keys()
 
     def __init__(self, verbosity=0, input_file_name=''):
         self.verbosity = verbosity
@@ -91,20 +283,11 @@ class FlipbookCreator:
         self.clip = None
         if self.input_file_name.endswith('.gif'):
             self.im = Image.open(self.input_file_name)
-            self.palette = self.im.getpalette()
             self.frames = AnimatedGif(self.im)
-            self.frame_count = len(list(AnimatedGif(self.im)))
+            self.frame_count = self.im.n_frames
             self.fps = 0
-            self.last_im = Image.new('P', self.im.size)
-            for i in range(0, 2):
-                for f in AnimatedGif(self.im):
-                    self.last_im.putpalette(self.palette)
-                    #  im = Image.alpha_composite(self.last_im, f.convert('RGBA'))
-                    im = self.last_im.copy()
-                    im.paste(f)
-                    self.last_im = im.copy()
         else:
-            self.clip = VideoFileClip(self.input_file_name)
+            self.clip = VideoClip(self.input_file_name)
             self.fps = self.clip.fps
             self.frame_count = int(self.clip.duration * self.clip.fps)
         if self.verbosity > 0:
@@ -117,29 +300,18 @@ class FlipbookCreator:
                 fps=10,
                 height_mm=50,
                 margins=Margin(10, 10, 10, 10),
-                paper_format='a4'):
-
-        def draw_raster():
-            for ix in range(0, nx + 1):
-                xx = x0 + ix * total.width
-                pdf.line(xx, y0, xx, y1)
-                if offset > 0 and ix != nx:
-                    pdf.line(xx + offset, y0, xx + offset, y1)
-            for iy in range(0, ny + 1):
-                yy = y0 + iy * total.height
-                pdf.line(x0, yy, x1, yy)
+                paper_format='a4',
+                resample='bilinear',
+                similar_bits=None):
 
         height_mm = float(height_mm)
-        tmp_files = []
+        resample_filter = self.RESAMPLE_FILTERS[resample.lower()]
         if self.clip:
             if fps != self.clip.fps:
                 if self.verbosity > 0:
-                    print(f'Transcoding from {self.clip.fps} fps to {fps} fps ...')
-                self.clip.write_videofile('tmp.mp4', fps=fps, audio=False)
-                tmp_files.append('tmp.mp4')
-                self.clip = VideoFileClip('tmp.mp4')
-                self.fps = self.clip.fps
-                self.frame_count = int(self.clip.duration * self.fps)
+                    print(f'Resampling from {self.clip.fps} fps to {fps} fps ...')
+                self.fps = fps
+                self.frame_count = len(self.clip.frame_times(fps))
             clip_size = Size.from_tuple(self.clip.size)
         elif self.frames:
             clip_size = Size.from_tuple(self.im.size)
@@ -153,6 +325,9 @@ class FlipbookCreator:
                      int(frame_mm.height / 25.4 * dpi))
         nx = int(printable_area.width / total.width)
         ny = int(printable_area.height / total.height)
+        if nx == 0 or ny == 0:
+            raise ValueError(f'{frame_mm.width:.2f}mm x {frame_mm.height:.2f}mm frame '
+                             'does not fit on the page')
         if self.verbosity > 0:
             print('Input:  {} fps, {}x{}, {} frames'\
                 '\n        from: {}'\
@@ -172,77 +347,128 @@ class FlipbookCreator:
                     nx, ny,
                     output_file_name
                 ))
-        pdf = FPDF(unit='mm', format=paper_format.upper(), orientation='L')
-        pdf.set_compression(True)
-        pdf.set_title('Funny video')
-        pdf.set_author('Oliver Lau <ola@ct.de> - Heise Medien GmbH & Co. KG')
-        pdf.set_creator('flippy')
-        pdf.set_keywords('flip-book, video, animated GIF')
-        pdf.set_draw_color(128, 128, 128)
-        pdf.set_line_width(0.1)
-        pdf.set_font('Helvetica', '', 12)
-        pdf.add_page()
+        pdf = self._create_pdf(paper_format)
         i = 0
-        page = 0
-        tx, ty = -1, 0
+        x, y = 0, 0
+        last_hash, last_buf = None, None
+        fingerprint = similar_bits is not None
         x0, y0 = margins.left, margins.top
-        x1, y1 = x0 + nx * total.width, y0 + ny * total.height
+        total_w, total_h = total.to_tuple()
+        frame_w, frame_h = frame_mm.to_tuple()
+        x1, y1 = x0 + nx * total_w, y0 + ny * total_h
+        image, text = pdf.image, pdf.text
+
+        # the raster is the same on every page
+        raster = []
+        for ix in range(0, nx + 1):
+            xx = x0 + ix * total_w
+            raster.append((xx, y0, xx, y1))
+            if offset > 0 and ix != nx:
+                raster.append((xx + offset, y0, xx + offset, y1))
+        for iy in range(0, ny + 1):
+            yy = y0 + iy * total_h
+            raster.append((x0, yy, x1, yy))
 
-        if self.clip:
-            all_frames = self.clip.iter_frames()
-        elif self.frames:
-            all_frames = AnimatedGif(self.im)
-        else:
-            all_frames = []
-        for f in all_frames:
-            ready = float(i + 1) / self.frame_count
-            if self.verbosity:
-                sys.stdout.write('\rProcessing frames |{:30}| {}%'
-                                 .format('X' * int(30 * ready), int(100 * ready)))
-                sys.stdout.flush()
-            tx += 1
-            if type(f) == GifImagePlugin.GifImageFile:
-                f.putpalette(self.palette)
-                self.last_im.paste(f)
-                im = self.last_im.convert('RGBA')
-            else:
-                im = Image.fromarray(f)
-                im.thumbnail(frame.to_tuple())
-            if tx == nx:
-                tx = 0
-                ty += 1
-                if ty == ny:
-                    ty = 0
-                    draw_raster()
-                    pdf.add_page()
-                    page += 1
-            temp_file = 'tmp-{}-{}-{}.png'.format(page, tx, ty)
-            im.save(temp_file)
-            tmp_files.append(temp_file)
-            x = x0 + tx * total.width
-            y = y0 + ty * total.height
-            pdf.image(temp_file,
-                      x=x + offset,
-                      y=y,
-                      w=frame_mm.width,
-                      h=frame_mm.height)
-            text = Point(x, y + frame_mm.height - 2)
+        def draw_raster():
+            for coords in raster:
+                pdf.line(*coords)
+
+        # (starts new page, x, y) of every tile
+        per_page = nx * ny
+        positions = []
+        for ix in range(self.frame_count):
+            tx, ty = ix % nx, ix % per_page // nx
+            positions.append((ix > 0 and ix % per_page == 0,
+                              x0 + tx * total_w,
+                              y0 + ty * total_h))
+        positions = iter(positions)
+
+        def place(encoded):
+            nonlocal i, x, y, last_hash, last_buf
+            # fpdf2 embeds identical image data only once. On request, a
+            # frame that looks like the previous one is replaced by it, so
+            # that its image object gets reused as well.
+            h, buf = encoded
+            if fingerprint:
+                if last_hash is not None and bin(h ^ last_hash).count('1') <= similar_bits:
+                    buf = last_buf
+                else:
+                    last_hash, last_buf = h, buf
+            progress.update()
+            new_page, x, y = next(positions)
+            if new_page:
+                draw_raster()
+                pdf.add_page()
+            image(buf,
+                  x=x + offset,
+                  y=y,
+                  w=frame_w,
+                  h=frame_h)
             if offset > 0:
-                pdf.rotate(90, text.x, text.y)
-                pdf.text(text.x, text.y + 5, '{}'.format(i))
-                pdf.rotate(0)
+                label_y = y + frame_h - 2
+                with pdf.rotation(90, x, label_y):
+                    text(x, label_y + 5, '{}'.format(i))
             i += 1
 
+        # Frames are encoded on worker threads; fpdf is not
+        # thread-safe, so they are placed on the page in submission order
+        # from this thread. At most max_pending frames are in flight.
+        workers = os.cpu_count() or 1
+        max_pending = 2 * workers
+        pending = deque()
+        with tqdm(total=self.frame_count, desc='Processing frames', unit='frame',
+                  disable=not self.verbosity) as progress, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            if self.clip:
+                futures = self._process_video(executor, frame, resample_filter, fingerprint)
+            else:
+                futures = self._process_gif(executor, fingerprint)
+            for future in futures:
+                pending.append(future)
+                if len(pending) >= max_pending:
+                    place(pending.popleft().result())
+            while pending:
+                place(pending.popleft().result())
+
         if y != 0 and x != 0:
             draw_raster()
 
         if self.verbosity > 0:
-            print('\nGenerating PDF ...')
+            print('Generating PDF ...')
         pdf.output(name=output_file_name)
-        if self.verbosity > 0:
-            print('Removing temporary files ...')
-        for temp_file in tmp_files:
-            os.remove(temp_file)
+
+    @staticmethod
+    def _create_pdf(paper_format):
+        pdf = FPDF(unit='mm', format=paper_format.upper(), orientation='L')
+        pdf.set_compression(True)
+        pdf.set_title('Funny video')
+        pdf.set_author('Oliver Lau <ola@ct.de> - Heise Medien GmbH & Co. KG')
+        pdf.set_creator('flippy')
+        pdf.set_keywords('flip-book, video, animated GIF')
+        pdf.set_draw_color(128, 128, 128)
+        pdf.set_line_width(0.1)
+        pdf.set_font('Helvetica', '', 12)
+        pdf.add_page()
+        return pdf
+
+    def _process_video(self, executor, frame, interpolation, fingerprint=False):
+        """ Submit the video frames for encoding, yielding the futures in frame order """
+        for f in self.clip.iter_frames(self.fps, frame.to_tuple(), interpolation):
+            yield executor.submit(encode_pixels, f, fingerprint)
+
+    def _process_gif(self, executor, fingerprint=False):
+        """ Flatten the GIF frames onto white paper and submit them for
+        encoding, yielding the futures in frame order """
+        canvas = np.empty((self.im.height, self.im.width, 3), dtype=np.uint8)
+        for f in self.frames:
+            # Pillow has already composited the frame onto its predecessors
+            # and applied the disposal methods, so each one stands alone.
+            layer = np.asarray(f.convert('RGBA'))
+            canvas.fill(255)
+            composite(canvas, layer)
+            # Pillow stores RGB pixels unpacked, so fromarray() copies
+            # the canvas and the encoder thread gets its own snapshot.
+            yield executor.submit(encode, Image.fromarray(canvas), fingerprint)
 
 
 def main():
@@ -255,6 +481,11 @@ def main():
     parser.add_argument('--phena', action='store_true', help='Create PDF to use in Phenakistoscope')
     parser.add_argument('--dpi', type=int, help='DPI', default=200)
     parser.add_argument('--fps', type=int, help='Frames per second', default=10)
+    parser.add_argument('--resample', type=str, choices=FlipbookCreator.RESAMPLE_CHOICES,
+                        help='Filter used to scale video frames', default='bilinear')
+    parser.add_argument('--similar', type=int, metavar='BITS',
+                        help='Reuse the previous frame if its perceptual hash differs '
+                             'in at most BITS bits (default: off)', default=None)
     parser.add_argument('-v', type=int, nargs='?', help='verbosity level', default=1)
     args = parser.parse_args()
 
@@ -270,7 +501,10 @@ def main():
         output_file_name=args.out,
         height_mm=args.height,
         dpi=args.dpi,
-        offset=args.offset
+        offset=args.offset,
+        fps=args.fps,
+        resample=args.resample,
+        similar_bits=args.similar
     )
 
 if __name__ == '__main__':